@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Venmo Email Parser for Gmail
-Reads Venmo payment notification emails and adds them to Excel spreadsheet
+Reads Venmo payment notification emails and appends them to a CSV file
 """
 
 from __future__ import annotations
@@ -9,22 +9,36 @@ from __future__ import annotations
 import argparse
 import base64
 import csv
+import html
 import json
 import logging
 import os
-import pickle
+import random
 import re
+import threading
 import time
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
-from email.utils import parsedate_to_datetime
-from typing import Optional
+from email.utils import parseaddr, parsedate_to_datetime
+from typing import Any, Callable, Iterable, Optional
 
 from dotenv import load_dotenv
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build, Resource
+from googleapiclient.errors import HttpError
+
+try:
+    import orjson  # Optional, faster JSON; stdlib json is used when missing
+except ImportError:
+    orjson = None
+
+try:
+    from google.cloud import pubsub_v1  # Optional, for Gmail push notifications
+except ImportError:
+    pubsub_v1 = None
 
 # Load environment variables
 load_dotenv()
@@ -34,10 +48,60 @@ CSV_PATH = os.getenv('CSV_PATH', 'payments.csv')
 GMAIL_LABEL = os.getenv('GMAIL_LABEL', 'Venmo')
 POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', '300'))
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '1'))
+PUBSUB_TOPIC = os.getenv('PUBSUB_TOPIC', '')
+PUBSUB_SUBSCRIPTION = os.getenv('PUBSUB_SUBSCRIPTION', '')
 
 # Constants
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
-PROCESSED_IDS_FILE = 'processed_messages.json'
+VENMO_SENDER = 'venmo@venmo.com'
+TOKEN_FILE = 'token.json'
+PROCESSED_IDS_FILE = 'processed_messages.log'
+LEGACY_PROCESSED_IDS_FILE = 'processed_messages.json'
+HISTORY_STATE_FILE = 'history_state.json'
+BATCH_SIZE = 50  # Gmail recommends at most 50 requests per batch
+FETCH_RETRIES = 4  # Resubmits of rate-limited or failed requests, with backoff
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+MAX_FAILED_CYCLES = 5  # Cycles a message may fail to download before it is given up on
+WATCH_RENEW_INTERVAL = 24 * 60 * 60  # Gmail watches expire after 7 days; renew daily
+
+# Payment pattern, compiled once at import rather than per email. Matches both
+# "FirstName LastName paid you $XX.XX" (incoming) and
+# "You paid FirstName LastName $XX.XX" (outgoing) in a single pass.
+# re.ASCII keeps \s and \d on cheap ASCII tables; the remaining Unicode
+# whitespace (non-breaking, thin and ideographic spaces, which show up between
+# words in HTML-derived text) is listed explicitly in _WS.
+_WS = r'[\s\x1c-\x1f\x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]'
+_PAYMENT_RE = re.compile(
+    rf'(?:(?P<in_name>[A-Z][a-z]+(?:{_WS}+[A-Z][a-z]+)*){_WS}+paid you'
+    rf'|You paid{_WS}+(?P<out_name>[A-Z][a-z]+(?:{_WS}+[A-Z][a-z]+)*))'
+    rf'{_WS}+\$(?P<amt>\d+(?:\.\d{{2}})?)',
+    re.ASCII
+)
+
+# Payment note - typically in quotes or after a dash. Each pattern is paired
+# with the characters it needs, so bodies without them skip the regex entirely.
+_NOTE_RES = [
+    (re.compile(r'["\u201c]([^"\u201d]+)["\u201d]', re.ASCII), ('"', '\u201c')),        # "note" or "note"
+    (re.compile(rf'[-\u2013\u2014]{_WS}*(.+?)(?:\n|$)', re.ASCII), ('-', '\u2013', '\u2014')),  # - note or — note
+]
+
+# The same patterns over raw UTF-8 body bytes, so decoded MIME parts needn't
+# be turned into str first (U+00A0 is \xc2\xa0, curly quotes and dashes \xe2\x80..)
+_WS_B = (rb'(?:[\s\x1c-\x1f]|\xc2[\x85\xa0]|\xe1\x9a\x80|\xe2\x80[\x80-\x8a\xa8\xa9\xaf]'
+         rb'|\xe2\x81\x9f|\xe3\x80\x80)')
+_PAYMENT_RE_B = re.compile(
+    rb'(?:(?P<in_name>[A-Z][a-z]+(?:' + _WS_B + rb'+[A-Z][a-z]+)*)' + _WS_B + rb'+paid you'
+    rb'|You paid' + _WS_B + rb'+(?P<out_name>[A-Z][a-z]+(?:' + _WS_B + rb'+[A-Z][a-z]+)*))'
+    + _WS_B + rb'+\$(?P<amt>\d+(?:\.\d{2})?)'
+)
+
+_NOTE_RES_B = [
+    (re.compile(rb'(?:"|\xe2\x80\x9c)((?:[^"\xe2]|\xe2(?!\x80\x9d))+)(?:"|\xe2\x80\x9d)'),
+     (b'"', b'\xe2\x80\x9c')),
+    (re.compile(rb'(?:-|\xe2\x80\x93|\xe2\x80\x94)' + _WS_B + rb'*(.+?)(?:\n|$)'),
+     (b'-', b'\xe2\x80\x93', b'\xe2\x80\x94')),
+]
 
 # Setup logging
 logging.basicConfig(
@@ -47,42 +111,99 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Label name (lowercased) -> Gmail label ID; label IDs never change
+_LABEL_ID_CACHE: dict[str, str] = {}
+
+# Message ID -> consecutive cycles it failed to download this run
+_FAILED_CYCLES: dict[str, int] = {}
+
+# Credentials from authenticate_gmail, used to give each fetch thread its own
+# service object (the underlying httplib2 connection is not thread-safe).
+# The pool lives for the whole run so those service objects are reused.
+_credentials: Optional[Credentials] = None
+_thread_local = threading.local()
+_fetch_executor: Optional[ThreadPoolExecutor] = None
 
-@dataclass
+# CSV paths known to already have a header row, so later appends skip the stat
+_CSV_HEADER_WRITTEN: set[str] = set()
+
+
+@dataclass(slots=True, frozen=True)
 class Payment:
     """Represents a Venmo payment."""
     name: str
     amount: float
     date: Optional[datetime] = None
     note: Optional[str] = None
+    is_outgoing: bool = field(init=False)
+
+    def __post_init__(self) -> None:
+        # Frozen instances can't assign normally; computed once instead of per access
+        object.__setattr__(self, 'is_outgoing', self.amount < 0)
+
 
-    @property
-    def is_outgoing(self) -> bool:
-        return self.amount < 0
+def read_json(path: str):
+    """Read a JSON file, using orjson when it is installed."""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json(path: str, data) -> None:
+    """Write data to a JSON file, using orjson when it is installed."""
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f)
 
 
 def load_processed_ids() -> set[str]:
-    """Load set of already processed message IDs from JSON file."""
+    """Load set of already processed message IDs from the append-only log."""
     if os.path.exists(PROCESSED_IDS_FILE):
         with open(PROCESSED_IDS_FILE, 'r') as f:
-            return set(json.load(f))
+            return set(f.read().split())
+
+    # Migrate IDs saved by older versions as a single JSON list
+    if os.path.exists(LEGACY_PROCESSED_IDS_FILE):
+        processed_ids = set(read_json(LEGACY_PROCESSED_IDS_FILE))
+        append_processed_ids(processed_ids)
+        return processed_ids
+
     return set()
 
 
-def save_processed_ids(processed_ids: set[str]) -> None:
-    """Save processed message IDs to JSON file."""
-    with open(PROCESSED_IDS_FILE, 'w') as f:
-        json.dump(list(processed_ids), f)
+def append_processed_ids(new_ids: Iterable[str]) -> None:
+    """Append newly processed message IDs to the log, one per line."""
+    lines = ''.join(f"{msg_id}\n" for msg_id in new_ids)
+    if lines:
+        with open(PROCESSED_IDS_FILE, 'a') as f:
+            f.write(lines)
+
+
+def load_history_id() -> Optional[str]:
+    """Load the Gmail history ID the previous run finished at, if any."""
+    if os.path.exists(HISTORY_STATE_FILE):
+        return read_json(HISTORY_STATE_FILE).get('history_id')
+    return None
+
+
+def save_history_id(history_id: str) -> None:
+    """Save the Gmail history ID to resume incremental listing from."""
+    write_json(HISTORY_STATE_FILE, {'history_id': history_id})
 
 
 def authenticate_gmail() -> Resource:
     """Authenticate with Gmail API and return service object."""
+    global _credentials
     creds: Optional[Credentials] = None
 
     # Token file stores user's access and refresh tokens
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
+    if os.path.exists(TOKEN_FILE):
+        creds = Credentials.from_authorized_user_info(read_json(TOKEN_FILE), SCOPES)
 
     # If no valid credentials, let user log in
     if not creds or not creds.valid:
@@ -94,27 +215,110 @@ def authenticate_gmail() -> Resource:
             creds = flow.run_local_server(port=0)
 
         # Save credentials for next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+        with open(TOKEN_FILE, 'w') as token:
+            token.write(creds.to_json())
 
+    _credentials = creds
     return build('gmail', 'v1', credentials=creds)
 
 
-def get_venmo_emails(service: Resource, label_name: str = GMAIL_LABEL) -> list[dict]:
-    """Fetch all emails from Venmo label, handling pagination."""
+def _thread_service() -> Resource:
+    """Return a Gmail service object owned by the current thread."""
+    service = getattr(_thread_local, 'service', None)
+    if service is None:
+        service = build('gmail', 'v1', credentials=_credentials, cache_discovery=False)
+        _thread_local.service = service
+    return service
+
+
+def _get_fetch_executor() -> ThreadPoolExecutor:
+    """Return the shared fetch thread pool, starting it on first use."""
+    global _fetch_executor
+    if _fetch_executor is None:
+        _fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS,
+                                             thread_name_prefix='gmail-fetch')
+    return _fetch_executor
+
+
+def get_label_id(service: Resource, label_name: str) -> Optional[str]:
+    """Look up a Gmail label ID by name, caching it for later polling cycles."""
+    key = label_name.lower()
+    if key in _LABEL_ID_CACHE:
+        return _LABEL_ID_CACHE[key]
+
+    labels = service.users().labels().list(userId='me').execute()
+
+    for label in labels.get('labels', []):
+        if label['name'].lower() == key:
+            _LABEL_ID_CACHE[key] = label['id']
+            return label['id']
+
+    return None
+
+
+def get_label_history(service: Resource, label_id: str,
+                      start_history_id: str) -> tuple[list[dict], str]:
+    """List messages added to a label since start_history_id, handling pagination.
+
+    Returns (messages, latest_history_id). Raises HttpError with status 404
+    if Gmail no longer has history that far back.
+    """
+    added: dict[str, dict] = {}
+    history_id = start_history_id
+    page_token: Optional[str] = None
+
+    while True:
+        results = service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            labelId=label_id,
+            historyTypes=['messageAdded', 'labelAdded'],
+            pageToken=page_token
+        ).execute()
+
+        # Messages can show up as newly received or as newly labeled
+        for record in results.get('history', []):
+            for change in record.get('messagesAdded', []) + record.get('labelsAdded', []):
+                message = change['message']
+                if label_id in message.get('labelIds', []):
+                    added[message['id']] = message
+
+        history_id = results.get('historyId', history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    return list(added.values()), history_id
+
+
+def get_venmo_emails(service: Resource, label_name: str = GMAIL_LABEL,
+                     history_id: Optional[str] = None) -> tuple[list[dict], Optional[str]]:
+    """Fetch emails from Venmo label, handling pagination.
+
+    With a history_id from a previous call, only messages added since then
+    are listed; otherwise every message in the label is listed.
+    Returns (messages, history_id to pass on the next call).
+    """
     try:
         # Get label ID for specified label
-        labels = service.users().labels().list(userId='me').execute()
-        label_id: Optional[str] = None
-
-        for label in labels.get('labels', []):
-            if label['name'].lower() == label_name.lower():
-                label_id = label['id']
-                break
+        label_id = get_label_id(service, label_name)
 
         if not label_id:
             logger.warning(f"Label '{label_name}' not found in Gmail")
-            return []
+            return [], history_id
+
+        if history_id:
+            try:
+                messages, history_id = get_label_history(service, label_id, history_id)
+                logger.info(f"Found {len(messages)} new email(s) in '{label_name}' label")
+                return messages, history_id
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logger.info("Gmail history expired, listing all emails instead")
+
+        # Note where history starts before listing so nothing arriving meanwhile is missed
+        profile = service.users().getProfile(userId='me').execute()
 
         # Fetch all messages with pagination
         all_messages: list[dict] = []
@@ -124,7 +328,7 @@ def get_venmo_emails(service: Resource, label_name: str = GMAIL_LABEL) -> list[d
             results = service.users().messages().list(
                 userId='me',
                 labelIds=[label_id],
-                q='from:venmo@venmo.com',
+                q=f'from:{VENMO_SENDER}',
                 pageToken=page_token
             ).execute()
 
@@ -138,11 +342,11 @@ def get_venmo_emails(service: Resource, label_name: str = GMAIL_LABEL) -> list[d
             logger.debug(f"Fetched {len(all_messages)} messages, getting next page...")
 
         logger.info(f"Found {len(all_messages)} total email(s) in '{label_name}' label")
-        return all_messages
+        return all_messages, profile['historyId']
 
     except Exception as e:
         logger.error(f"Error fetching emails: {e}")
-        return []
+        return [], history_id
 
 
 def extract_payment_info(email_body: str) -> tuple[Optional[str], Optional[float], Optional[str]]:
@@ -153,39 +357,58 @@ def extract_payment_info(email_body: str) -> tuple[Optional[str], Optional[float
     - Outgoing payments (You paid X): negative amount
     - Note: the payment memo if found
     """
+    return _scan_payment(email_body, _PAYMENT_RE, _NOTE_RES, 'paid you', 'You paid', str)
+
+
+def extract_payment_info_bytes(email_body: bytes) -> tuple[Optional[str], Optional[float], Optional[str]]:
+    """Same as extract_payment_info for a raw UTF-8 body; only matches are decoded."""
+    return _scan_payment(email_body, _PAYMENT_RE_B, _NOTE_RES_B, b'paid you', b'You paid',
+                         _decode_utf8)
+
+
+def _decode_utf8(data: bytes) -> str:
+    """Decode matched body bytes, tolerating malformed UTF-8."""
+    return data.decode('utf-8', errors='replace')
+
+
+def _scan_payment(email_body: str | bytes, payment_re: re.Pattern,
+                  note_res: list[tuple[re.Pattern, tuple]], incoming_phrase: str | bytes,
+                  outgoing_phrase: str | bytes,
+                  decode: Callable[[Any], str]) -> tuple[Optional[str], Optional[float], Optional[str]]:
+    """Shared str/bytes implementation; decode turns matched text into str."""
     name: Optional[str] = None
     amount: Optional[float] = None
     note: Optional[str] = None
 
-    # Pattern for "FirstName LastName paid you $XX.XX" (incoming)
-    incoming_pattern = r'([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)\s+paid you\s+\$(\d+(?:\.\d{2})?)'
-
-    # Pattern for "You paid FirstName LastName $XX.XX" (outgoing)
-    outgoing_pattern = r'You paid\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)\s+\$(\d+(?:\.\d{2})?)'
-
-    # Pattern for payment note - typically in quotes or after a dash
-    note_patterns = [
-        r'["\u201c]([^"\u201d]+)["\u201d]',  # "note" or "note"
-        r'[-\u2013\u2014]\s*(.+?)(?:\n|$)',   # - note or — note
-    ]
+    # Only run the regex when a payment phrase is present, starting from its line
+    incoming_at = email_body.find(incoming_phrase)
+    outgoing_at = email_body.find(outgoing_phrase)
+    start = outgoing_at if incoming_at < 0 or 0 <= outgoing_at < incoming_at else incoming_at
+    if start >= 0:
+        newline = b'\n' if isinstance(email_body, bytes) else '\n'
+        line_start = email_body.rfind(newline, 0, start) + 1
+        match = payment_re.search(email_body, line_start)
+
+        # The name may start on an earlier line when everything on this line before
+        # it is whitespace and the text before the line break ends in a letter
+        if (line_start and not decode(email_body[line_start:match.start() if match else start]).strip()
+                and decode(email_body[:line_start]).rstrip()[-1:].isalpha()):
+            match = payment_re.search(email_body)
 
-    # Check for incoming payment
-    match = re.search(incoming_pattern, email_body)
-    if match:
-        name = match.group(1)
-        amount = float(match.group(2))
-    else:
-        # Check for outgoing payment
-        match = re.search(outgoing_pattern, email_body)
         if match:
-            name = match.group(1)
-            amount = -float(match.group(2))  # Negative for outgoing
+            in_name, out_name, amt = match.group('in_name', 'out_name', 'amt')
+            if in_name:
+                name, amount = decode(in_name), float(amt)
+            else:
+                name, amount = decode(out_name), -float(amt)  # Negative for outgoing
 
     # Try to extract note
-    for pattern in note_patterns:
-        note_match = re.search(pattern, email_body)
+    for note_re, markers in note_res:
+        if not any(marker in email_body for marker in markers):
+            continue
+        note_match = note_re.search(email_body)
         if note_match:
-            potential_note = note_match.group(1).strip()
+            potential_note = decode(note_match.group(1)).strip()
             # Filter out common non-note matches
             if potential_note and len(potential_note) > 1 and not potential_note.startswith('http'):
                 note = potential_note
@@ -194,6 +417,17 @@ def extract_payment_info(email_body: str) -> tuple[Optional[str], Optional[float
     return name, amount, note
 
 
+def is_from_venmo(message: dict) -> bool:
+    """Check whether the message was sent by Venmo's notification address."""
+    headers = message.get('payload', {}).get('headers', [])
+
+    for header in headers:
+        if header['name'].lower() == 'from':
+            return parseaddr(header['value'])[1].lower() == VENMO_SENDER
+
+    return False
+
+
 def get_email_date(message: dict) -> Optional[datetime]:
     """Extract date from email message headers."""
     headers = message.get('payload', {}).get('headers', [])
@@ -216,18 +450,150 @@ def get_email_date(message: dict) -> Optional[datetime]:
     return None
 
 
-def parse_email_content(service: Resource, message_id: str) -> Optional[Payment]:
-    """Get email content and extract payment info."""
+def fetch_messages(service: Resource, message_ids: list[str],
+                   msg_format: str = 'full') -> dict[str, Optional[dict]]:
+    """Fetch messages using batched requests. Returns messages keyed by ID.
+
+    'metadata' format returns just the snippet, Date and From headers, which is all
+    most Venmo emails need; 'full' includes the MIME body parts.
+    Batches run on up to FETCH_WORKERS threads at once (serially by default).
+    Messages deleted since they were listed, or rejected with another 4xx
+    error than 429, map to None. Messages that fail to download for any other
+    reason are logged and left out of the result.
+    """
+    chunks = [message_ids[start:start + BATCH_SIZE]
+              for start in range(0, len(message_ids), BATCH_SIZE)]
+    fetched: dict[str, Optional[dict]] = {}
+
+    if len(chunks) <= 1 or FETCH_WORKERS <= 1 or _credentials is None:
+        for chunk in chunks:
+            fetched.update(_fetch_batch(service, chunk, msg_format))
+            logger.debug(f"Fetched {len(fetched)} of {len(message_ids)} message(s)")
+        return fetched
+
+    def fetch_chunk(chunk: list[str]) -> dict[str, Optional[dict]]:
+        return _fetch_batch(_thread_service(), chunk, msg_format)
+
+    for result in _get_fetch_executor().map(fetch_chunk, chunks):
+        fetched.update(result)
+        logger.debug(f"Fetched {len(fetched)} of {len(message_ids)} message(s)")
+
+    return fetched
+
+
+def _fetch_batch(service: Resource, message_ids: list[str],
+                 msg_format: str) -> dict[str, Optional[dict]]:
+    """Fetch up to BATCH_SIZE messages in a single batched HTTP request.
+
+    Requests that are rate limited or hit a server error are resubmitted with
+    jittered exponential backoff, up to FETCH_RETRIES times.
+    """
+    fetched: dict[str, Optional[dict]] = {}
+    extra_args = {'metadataHeaders': ['Date', 'From']} if msg_format == 'metadata' else {}
+    failed: set[str] = set()
+    pending = message_ids
+
+    for attempt in range(FETCH_RETRIES + 1):
+        retry_ids: list[str] = []
+
+        def on_message(request_id: str, response: dict, exception: Optional[Exception]) -> None:
+            if exception is None:
+                fetched[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status in (404, 410):
+                # Deleted after it was listed; retrying will never succeed
+                logger.warning(f"Email {request_id} no longer exists")
+                fetched[request_id] = None
+            elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES:
+                retry_ids.append(request_id)
+            elif isinstance(exception, HttpError) and 400 <= exception.resp.status < 500:
+                # Rejected outright (e.g. 400/403); asking again will get the same answer
+                logger.error(f"Error fetching email {request_id}: {exception}")
+                fetched[request_id] = None
+            else:
+                logger.error(f"Error fetching email {request_id}: {exception}")
+                failed.add(request_id)
+
+        if attempt:
+            delay = min(2 ** attempt, 32) * random.uniform(0.5, 1.5)
+            logger.debug(f"Retrying {len(pending)} email(s) in {delay:.1f}s")
+            time.sleep(delay)
+
+        batch = service.new_batch_http_request(callback=on_message)
+        for message_id in pending:
+            batch.add(
+                service.users().messages().get(
+                    userId='me',
+                    id=message_id,
+                    format=msg_format,
+                    **extra_args
+                ),
+                request_id=message_id
+            )
+
+        try:
+            batch.execute()
+        except Exception as e:
+            # Whole batch failed (e.g. network error); also retry whatever didn't come back
+            logger.debug(f"Error fetching email batch: {e}")
+            handled = fetched.keys() | failed | set(retry_ids)
+            retry_ids += [msg_id for msg_id in pending if msg_id not in handled]
+
+        pending = retry_ids
+        if not pending:
+            break
+
+    if pending:
+        logger.error(f"Could not fetch {len(pending)} email(s) after {FETCH_RETRIES} retries, "
+                     "will try again next cycle")
+
+    return fetched
+
+
+def _parse_snippet(message: dict) -> tuple[Optional[Payment], bool]:
+    """Extract payment info from the message snippet.
+
+    Returns (payment, settled). Snippets have no line breaks and are cut off
+    at about 200 characters, so a dash note runs on to the end and a quoted
+    note may lose its closing quote. Only a complete quoted note is taken;
+    settled is False when the snippet shows a note marker without one.
+    """
+    # Snippets are HTML-escaped, e.g. quotes around the note arrive as &quot;
+    snippet = html.unescape(message.get('snippet', ''))
+    name, amount, note = _scan_payment(snippet, _PAYMENT_RE, _NOTE_RES[:1],
+                                       'paid you', 'You paid', str)
+
+    if not name or amount is None:
+        return None, False
+
+    payment = Payment(
+        name=name,
+        amount=amount,
+        date=get_email_date(message),
+        note=note
+    )
+    settled = note is not None or not any(
+        marker in snippet for _, markers in _NOTE_RES for marker in markers
+    )
+    return payment, settled
+
+
+def parse_email_content(message: dict, full_body: bool = True) -> Optional[Payment]:
+    """Extract payment info from a fetched email message.
+
+    The short snippet is tried first; the MIME body is decoded only when the
+    snippet doesn't settle the payment and its note. Pass full_body=False for
+    'metadata' format messages: None then means the full message is needed.
+    """
     try:
-        message = service.users().messages().get(
-            userId='me',
-            id=message_id,
-            format='full'
-        ).execute()
+        snippet_payment, settled = _parse_snippet(message)
+        if settled:
+            return snippet_payment
+        if not full_body:
+            return None
 
-        # Extract email body
+        # Fall back to the email body, kept as raw bytes for matching
         parts = message.get('payload', {}).get('parts', [])
-        email_body = ''
+        email_body = b''
 
         # Handle different email structures
         if parts:
@@ -235,54 +601,59 @@ def parse_email_content(service: Resource, message_id: str) -> Optional[Payment]
                 if part.get('mimeType') == 'text/plain':
                     data = part.get('body', {}).get('data', '')
                     if data:
-                        email_body = base64.urlsafe_b64decode(data).decode('utf-8')
+                        email_body = base64.urlsafe_b64decode(data)
                         break
         else:
             # Email body might be directly in payload
             data = message.get('payload', {}).get('body', {}).get('data', '')
             if data:
-                email_body = base64.urlsafe_b64decode(data).decode('utf-8')
+                email_body = base64.urlsafe_b64decode(data)
 
-        # Also check snippet for simpler emails
-        if not email_body:
-            email_body = message.get('snippet', '')
+        if email_body:
+            name, amount, note = extract_payment_info_bytes(email_body)
 
-        name, amount, note = extract_payment_info(email_body)
+            if name and amount is not None:
+                return Payment(
+                    name=name,
+                    amount=amount,
+                    date=get_email_date(message),
+                    note=note
+                )
 
-        if name and amount is not None:
-            return Payment(
-                name=name,
-                amount=amount,
-                date=get_email_date(message),
-                note=note
-            )
-
-        return None
+        # No usable body; the snippet's name and amount are still better than nothing
+        return snippet_payment
 
     except Exception as e:
-        logger.error(f"Error parsing email {message_id}: {e}")
+        logger.error(f"Error parsing email {message.get('id')}: {e}")
         return None
 
 
+def _csv_row(payment: Payment) -> tuple:
+    """Format a payment as a (Name, Amount IN, Amount OUT, Date, Note) row."""
+    amount = payment.amount
+    outgoing = payment.is_outgoing
+    magnitude = -amount if outgoing else amount
+    date_str = payment.date.strftime('%Y-%m-%d %H:%M:%S') if payment.date else ''
+    return (payment.name, '' if outgoing else magnitude, magnitude if outgoing else '',
+            date_str, payment.note or '')
+
+
 def add_to_csv(csv_path: str, payments: list[Payment]) -> bool:
     """Add payment data to CSV file. Returns True on success."""
     try:
-        # Check if file exists to determine if we need headers
-        file_exists = os.path.exists(csv_path)
+        # Check if file exists to determine if we need headers (once per path)
+        needs_header = csv_path not in _CSV_HEADER_WRITTEN and not os.path.exists(csv_path)
 
         with open(csv_path, 'a', newline='') as f:
             writer = csv.writer(f)
 
             # Write header if new file
-            if not file_exists:
+            if needs_header:
                 writer.writerow(['Name', 'Amount IN', 'Amount OUT', 'Date', 'Note'])
 
-            # Write each payment
-            for payment in payments:
-                amount_in = payment.amount if not payment.is_outgoing else ''
-                amount_out = abs(payment.amount) if payment.is_outgoing else ''
-                date_str = payment.date.strftime('%Y-%m-%d %H:%M:%S') if payment.date else ''
-                writer.writerow([payment.name, amount_in, amount_out, date_str, payment.note or ''])
+            writer.writerows(_csv_row(payment) for payment in payments)
+
+        _CSV_HEADER_WRITTEN.add(csv_path)
 
         logger.info(f"Added {len(payments)} payment(s) to CSV")
         return True
@@ -292,44 +663,161 @@ def add_to_csv(csv_path: str, payments: list[Payment]) -> bool:
         return False
 
 
-def run_parser(service: Resource, csv_path: str, processed_ids: set[str]) -> int:
-    """Run a single parsing cycle. Returns number of new payments processed."""
-    messages = get_venmo_emails(service)
-
-    if not messages:
-        logger.info("No Venmo emails found")
-        return 0
+def _update_history_id(old_history_id: Optional[str], new_history_id: Optional[str]) -> None:
+    """Persist the history ID if the cycle advanced it."""
+    if new_history_id and new_history_id != old_history_id:
+        save_history_id(new_history_id)
 
-    # Filter out already processed messages
-    new_messages = [msg for msg in messages if msg['id'] not in processed_ids]
 
-    if not new_messages:
-        logger.info("No new emails to process")
-        return 0
+def run_parser(service: Resource, csv_path: str, processed_ids: set[str],
+               history_id: Optional[str] = None) -> tuple[int, Optional[str]]:
+    """Run a single parsing cycle.
 
-    logger.info(f"Processing {len(new_messages)} new email(s)")
+    Returns (number of new payments processed, history ID for the next cycle).
+    """
+    messages, next_history_id = get_venmo_emails(service, history_id=history_id)
+
+    # Filter out already processed messages with a C-level set difference,
+    # only building the ordered list when there is something new
+    new_id_set = {msg['id'] for msg in messages} - processed_ids
+
+    if not new_id_set:
+        logger.info("No new emails to process" if messages else "No Venmo emails found")
+        _update_history_id(history_id, next_history_id)
+        return 0, next_history_id
+
+    # Keep Gmail's ordering so CSV rows come out in the same order as before
+    new_ids = [msg['id'] for msg in messages if msg['id'] in new_id_set]
+    logger.info(f"Processing {len(new_ids)} new email(s)")
+
+    # Try the lightweight metadata format first; most payments parse from the snippet
+    fetched = fetch_messages(service, new_ids, 'metadata')
+    # Deleted messages and mail from other senders are skipped but still marked processed
+    skipped: set[str] = set()
+    parsed: dict[str, Optional[Payment]] = {}
+    for msg_id, message in fetched.items():
+        if message is None:
+            skipped.add(msg_id)
+        elif not is_from_venmo(message):
+            logger.debug(f"  Skipping message {msg_id}: not from {VENMO_SENDER}")
+            skipped.add(msg_id)
+        else:
+            parsed[msg_id] = parse_email_content(message, full_body=False)
+
+    # Re-request the full body only for messages the snippet couldn't settle
+    retry_ids = [msg_id for msg_id, payment in parsed.items() if payment is None]
+    if retry_ids:
+        logger.debug(f"Fetching full body for {len(retry_ids)} message(s)")
+        full_messages = fetch_messages(service, retry_ids, 'full')
+        for msg_id in retry_ids:
+            message = full_messages.get(msg_id)
+            if message is not None:
+                parsed[msg_id] = parse_email_content(message)
+            else:
+                del parsed[msg_id]
+                if msg_id in full_messages:
+                    skipped.add(msg_id)
 
     payments: list[Payment] = []
-    for msg in new_messages:
-        payment = parse_email_content(service, msg['id'])
+    newly_processed: list[str] = []
+    for msg_id in new_ids:
+        if msg_id not in parsed and msg_id not in skipped:
+            failed_cycles = _FAILED_CYCLES.get(msg_id, 0) + 1
+            if failed_cycles < MAX_FAILED_CYCLES:
+                # Download failed temporarily; leave unprocessed so the next cycle retries it
+                _FAILED_CYCLES[msg_id] = failed_cycles
+                continue
+            # Stop it holding the history ID back forever
+            logger.error(f"  Giving up on message {msg_id} after {failed_cycles} failed cycles")
+            skipped.add(msg_id)
+        _FAILED_CYCLES.pop(msg_id, None)
+
+        payment = parsed.get(msg_id)
         if payment:
             payments.append(payment)
             direction = "paid you" if not payment.is_outgoing else "you paid"
             amount_display = abs(payment.amount)
             note_display = f' - "{payment.note}"' if payment.note else ''
             logger.info(f"  Found: {payment.name} {direction} ${amount_display:.2f}{note_display}")
-        else:
-            logger.warning(f"  Could not parse message {msg['id']}")
+        elif msg_id not in skipped:
+            logger.warning(f"  Could not parse message {msg_id}")
 
         # Mark as processed regardless of parse success
-        processed_ids.add(msg['id'])
+        processed_ids.add(msg_id)
+        newly_processed.append(msg_id)
 
     if payments:
         add_to_csv(csv_path, payments)
-    else:
+    elif parsed:
         logger.warning("No payment information could be extracted from new emails")
 
-    return len(payments)
+    append_processed_ids(newly_processed)
+
+    if len(newly_processed) < len(new_ids):
+        # Some downloads failed temporarily; re-list from the old position so they get retried
+        next_history_id = history_id
+    _update_history_id(history_id, next_history_id)
+
+    return len(payments), next_history_id
+
+
+def start_watch(service: Resource, label_id: str, topic: str) -> None:
+    """Ask Gmail to publish changes to the label on a Pub/Sub topic."""
+    response = service.users().watch(
+        userId='me',
+        body={
+            'labelIds': [label_id],
+            'labelFilterBehavior': 'include',
+            'topicName': topic
+        }
+    ).execute()
+    logger.debug(f"Gmail watch active until {response.get('expiration')}")
+
+
+def run_push(service: Resource, csv_path: str, processed_ids: set[str],
+             history_id: Optional[str], label_id: str) -> Optional[str]:
+    """Parse new emails whenever Gmail sends a Pub/Sub notification.
+
+    Expects start_watch to have succeeded already; the watch is renewed daily.
+    Runs until interrupted, or until the subscriber stops, in which case the
+    latest history ID is returned so the caller can fall back to polling.
+    """
+    wake = threading.Event()
+
+    def on_notification(message) -> None:
+        # The notification only says something changed; run_parser works out what
+        message.ack()
+        wake.set()
+
+    subscriber = pubsub_v1.SubscriberClient()
+    streaming_pull = subscriber.subscribe(PUBSUB_SUBSCRIPTION, callback=on_notification)
+    streaming_pull.add_done_callback(lambda _: wake.set())
+
+    try:
+        renew_at = time.monotonic() + WATCH_RENEW_INTERVAL
+        while True:
+            if streaming_pull.done():
+                logger.error(f"Pub/Sub subscriber stopped: {streaming_pull.exception()}")
+                return history_id
+
+            if time.monotonic() >= renew_at:
+                try:
+                    start_watch(service, label_id, PUBSUB_TOPIC)
+                    renew_at = time.monotonic() + WATCH_RENEW_INTERVAL
+                except Exception as e:
+                    # The current watch stays valid for days; try again after a short wait
+                    logger.error(f"Error renewing Gmail watch, retrying in {POLL_INTERVAL}s: {e}")
+                    renew_at = time.monotonic() + POLL_INTERVAL
+
+            # Clear before parsing so notifications arriving mid-run aren't lost
+            wake.clear()
+            _, history_id = run_parser(service, csv_path, processed_ids, history_id)
+
+            logger.debug("Waiting for Gmail notification...")
+            wake.wait(timeout=max(0.0, renew_at - time.monotonic()))
+    finally:
+        streaming_pull.cancel()
+        subscriber.close()
 
 
 def main() -> None:
@@ -337,6 +825,8 @@ def main() -> None:
     parser = argparse.ArgumentParser(description='Venmo Email Parser for Gmail')
     parser.add_argument('--once', action='store_true',
                         help='Run once and exit instead of continuous polling')
+    parser.add_argument('--poll', action='store_true',
+                        help='Poll every POLL_INTERVAL seconds even if Pub/Sub is configured')
     args = parser.parse_args()
 
     logger.info("Venmo Email Parser starting")
@@ -349,25 +839,44 @@ def main() -> None:
     # Load previously processed message IDs
     processed_ids = load_processed_ids()
     logger.info(f"Loaded {len(processed_ids)} previously processed message ID(s)")
+    history_id = load_history_id()
 
     if args.once:
         # Single run mode
-        run_parser(service, CSV_PATH, processed_ids)
-        save_processed_ids(processed_ids)
+        run_parser(service, CSV_PATH, processed_ids, history_id)
         logger.info("Complete!")
-    else:
+        return
+
+    label_id: Optional[str] = None
+    if not args.poll and PUBSUB_TOPIC and PUBSUB_SUBSCRIPTION:
+        if pubsub_v1 is None:
+            logger.warning("google-cloud-pubsub is not installed, falling back to polling")
+        else:
+            try:
+                label_id = get_label_id(service, GMAIL_LABEL)
+                if label_id:
+                    start_watch(service, label_id, PUBSUB_TOPIC)
+                else:
+                    logger.warning(f"Label '{GMAIL_LABEL}' not found in Gmail, falling back to polling")
+            except Exception as e:
+                logger.error(f"Could not start Gmail watch, falling back to polling: {e}")
+                label_id = None
+
+    try:
+        if label_id:
+            # Push mode: only wake up when Gmail reports a change
+            logger.info(f"Listening for Gmail notifications on {PUBSUB_SUBSCRIPTION} (Ctrl+C to stop)")
+            history_id = run_push(service, CSV_PATH, processed_ids, history_id, label_id)
+            logger.warning("Push notifications stopped, falling back to polling")
+
         # Continuous polling mode
         logger.info(f"Starting continuous polling (every {POLL_INTERVAL}s, Ctrl+C to stop)")
-        try:
-            while True:
-                run_parser(service, CSV_PATH, processed_ids)
-                save_processed_ids(processed_ids)
-                logger.debug(f"Sleeping for {POLL_INTERVAL} seconds...")
-                time.sleep(POLL_INTERVAL)
-        except KeyboardInterrupt:
-            logger.info("Stopping parser...")
-            save_processed_ids(processed_ids)
-            logger.info("Processed IDs saved. Goodbye!")
+        while True:
+            _, history_id = run_parser(service, CSV_PATH, processed_ids, history_id)
+            logger.debug(f"Sleeping for {POLL_INTERVAL} seconds...")
+            time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logger.info("Stopping parser... Goodbye!")
 
 
 if __name__ == '__main__':